@@ -2,10 +2,9 @@ import asyncio
 import fractions  # Add this import for Fraction
 import logging
 import os
-import queue
 import time
-import traceback
 import wave
+from collections import deque
 from datetime import datetime
 
 import aiohttp
@@ -13,6 +12,7 @@ import numpy as np
 import pyaudio
 from aiortc import RTCPeerConnection, RTCSessionDescription
 from aiortc.mediastreams import AudioStreamTrack, MediaStreamError
+from av import AudioFrame, AudioResampler
 
 # Set up logging
 # Ensure logs directory exists
@@ -21,17 +21,25 @@ os.makedirs("logs", exist_ok=True)
 # Create a unique log filename with timestamp
 log_filename = f"logs/client_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
 
+# Log level can be changed without editing the code, e.g. LOG_LEVEL=WARNING
+log_level_name = os.environ.get("LOG_LEVEL", "INFO").upper()
+log_level = logging.getLevelName(log_level_name)
+unknown_log_level = not isinstance(log_level, int)
+if unknown_log_level:
+    # e.g. a typo: fall back rather than fail at import
+    log_level = logging.INFO
+
 # Set up logging to both console and file
 logger = logging.getLogger("WebRTC-Test-Client")
-logger.setLevel(logging.INFO)
+logger.setLevel(log_level)
 
 # Create console handler
 console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO)
+console_handler.setLevel(log_level)
 
 # Create file handler
 file_handler = logging.FileHandler(log_filename, encoding="utf-8")
-file_handler.setLevel(logging.INFO)
+file_handler.setLevel(log_level)
 
 # Create formatter and add it to the handlers
 formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
@@ -42,26 +50,43 @@ file_handler.setFormatter(formatter)
 logger.addHandler(console_handler)
 logger.addHandler(file_handler)
 
+if unknown_log_level:
+    logger.warning(f"Unknown LOG_LEVEL {log_level_name!r}, using INFO")
+
 logger.info(f"Logging to file: {log_filename}")
 
 # Ensure recordings directory exists
 os.makedirs("client_recordings", exist_ok=True)
 
+# PyAV channel layout names, indexed by channel count
+CHANNEL_LAYOUTS = (None, "mono", "stereo")
+
 
 class AudioStreamPlayer:
     """Class to play received audio in real-time and optionally record it."""
 
-    def __init__(self, track, buffer_size=2048):  # Smaller buffer for less latency
+    def __init__(self, track, buffer_size=960):  # One 20 ms Opus frame per callback
         self.track = track
         self.buffer_size = buffer_size
-        # Jitter buffer implementation as a queue
-        self.audio_queue = queue.Queue(maxsize=20)  # Smaller queue to reduce latency
+        # Jitter buffer as a bounded deque: appends evict the oldest frame and
+        # append/popleft are atomic, so the PyAudio thread needs no lock
+        self.audio_queue = deque(maxlen=20)  # Smaller queue to reduce latency
         self.running = False
         self.sample_rate = 48000  # WebRTC default
         self.pyaudio_instance = pyaudio.PyAudio()
         self.stream = None
         self.prebuffer_count = 3  # Fewer frames to reduce initial delay
         self.prebuffer_done = False
+        self.worker_task = None
+        # aiortc decodes Opus to stereo; downmix to the mono s16 stream that
+        # is played and recorded (and resample if the rate ever differs)
+        self.resampler = AudioResampler(
+            format="s16", layout="mono", rate=self.sample_rate
+        )
+        # Reused int16 output buffer for frame conversion
+        self._pcm_buffer = None
+        # Reusable zero buffer for silence and for padding short chunks
+        self._zeros = bytes(buffer_size * 2)
 
         # Recording variables
         self.should_record = True
@@ -69,29 +94,47 @@ class AudioStreamPlayer:
             f"client_recordings/server_audio_{int(time.time())}.wav"
         )
         self.wav_file = None
-        self.all_audio_data = bytearray()
+        # Pre-sized spill buffer, filled in place up to buffered_audio bytes
+        self.all_audio_data = None
+        self.buffered_audio = 0
+        self.recorded_bytes = 0  # Running total, including spilled audio
+        # Spill buffered audio to the WAV file past this size to bound memory
+        self.max_buffered_audio = 1024 * 1024  # 1 MiB
+        self._recording_write = None  # In-flight spill to the WAV file
+
+    def _silence(self, size):
+        """Return a cached zero-filled buffer of exactly size bytes."""
+        if len(self._zeros) != size:
+            self._zeros = bytes(size)
+        return self._zeros
 
     def audio_callback(self, in_data, frame_count, time_info, status):
         """PyAudio callback to fetch and play audio data"""
         # If pre-buffering is not complete, return silence
         if not self.prebuffer_done:
-            return (b"\x00" * frame_count * 2, pyaudio.paContinue)
+            return (self._silence(frame_count * 2), pyaudio.paContinue)
 
         try:
             # Try to get data from the queue
-            data = self.audio_queue.get_nowait()
+            data = self.audio_queue.popleft()
             # Check if data size matches expected size (2 bytes per sample)
             expected_size = frame_count * 2
+            if len(data) == expected_size:
+                # Common case: buffer_size matches the decoded frame size,
+                # so the frame is played as-is without a copy
+                return (data, pyaudio.paContinue)
             if len(data) < expected_size:
-                # Pad with zeros if too short
-                data = data + b"\x00" * (expected_size - len(data))
+                # Pad with zeros if too short, slicing the cached buffer
+                # so only the padded result is allocated
+                pad = expected_size - len(data)
+                data = data + memoryview(self._silence(expected_size))[:pad]
             elif len(data) > expected_size:
                 # Truncate if too long
                 data = data[:expected_size]
             return (data, pyaudio.paContinue)
-        except queue.Empty:
+        except IndexError:
             # If queue is empty, return silence
-            return (b"\x00" * frame_count * 2, pyaudio.paContinue)
+            return (self._silence(frame_count * 2), pyaudio.paContinue)
 
     async def start(self):
         """Start playing audio from the track."""
@@ -119,6 +162,7 @@ class AudioStreamPlayer:
                 self.wav_file.setnchannels(1)  # Mono
                 self.wav_file.setsampwidth(2)  # 16-bit
                 self.wav_file.setframerate(self.sample_rate)  # 48kHz
+                self.all_audio_data = bytearray(self.max_buffered_audio)
             except Exception as e:
                 logger.error(f"Error creating WAV file: {e}")
                 self.should_record = False
@@ -126,50 +170,104 @@ class AudioStreamPlayer:
         # Start the worker to receive frames
         self.worker_task = asyncio.create_task(self._receive_frames())
 
+    def _frame_samples(self, frame):
+        """Return a frame's audio as mono int16 samples at the playback rate."""
+        # Resampled frames are packed s16 in a single plane, so view it
+        # directly instead of going through to_ndarray(). count skips any
+        # padding at the plane's end.
+        samples = [
+            np.frombuffer(out.planes[0], dtype=np.int16, count=out.samples)
+            for out in self.resampler.resample(frame)
+        ]
+        if len(samples) == 1:
+            return samples[0]
+        return np.concatenate(samples) if samples else np.empty(0, dtype=np.int16)
+
+    def _to_pcm(self, audio_data):
+        """Normalize a frame's samples and convert them to int16 PCM bytes."""
+        # Check if audio data is already in reasonable range. Take the peak
+        # from max() and min() rather than np.abs(), which would allocate a
+        # temporary array (and wraps -32768 around for int16 input)
+        max_val = max(float(audio_data.max()), -float(audio_data.min()))
+
+        # Silent frames (common with Opus DTX) need no scaling, and
+        # normalizing them would divide by a zero peak
+        if max_val == 0:
+            return bytes(audio_data.size * 2)
+
+        # Fold normalization, the low-volume boost and int16 scaling into a
+        # single gain so the frame is scaled once instead of once per step
+        gain = 32767.0
+        # Normalize only if needed (if max amplitude is too low or too high)
+        if max_val > 1.0 or max_val < 0.1:
+            gain *= 0.8 / max_val
+        # Apply a small gain boost if volume is too low
+        if max_val < 0.3:
+            gain *= 1.5
+
+        # float32 is ample for int16 output and halves the temporary's size
+        scaled = np.multiply(audio_data, gain, dtype=np.float32)
+        # Simple limiter to avoid clipping, applied in place
+        np.clip(scaled, -0.95 * 32767, 0.95 * 32767, out=scaled)
+
+        # Cast into a reused int16 buffer rather than a fresh astype() array
+        if self._pcm_buffer is None or self._pcm_buffer.shape != scaled.shape:
+            self._pcm_buffer = np.empty(scaled.shape, dtype=np.int16)
+        np.copyto(self._pcm_buffer, scaled, casting="unsafe")
+        return self._pcm_buffer.tobytes()
+
     async def _receive_frames(self):
         """Worker to receive frames from the track and add them to the queue."""
         prebuffer_frames = 0
+        conversion_errors = 0
+        # Bind per-frame lookups to locals once for the receive loop
+        recv = self.track.recv
+        frame_samples = self._frame_samples
+        to_pcm = self._to_pcm
+        audio_queue = self.audio_queue
+        enqueue = audio_queue.append
+        dequeue = audio_queue.popleft
+        # Integer high-water mark: trim once the buffer is over 80% full
+        high_water = audio_queue.maxlen * 4 // 5
 
         try:
             while self.running:
                 try:
-                    frame = await self.track.recv()
-
-                    # Get audio data and ensure it's in the correct format
-                    audio_data = frame.to_ndarray()
+                    frame = await recv()
 
-                    # Improved conversion to int16 with proper normalization
                     try:
-                        # Check if audio data is already in reasonable range
-                        max_val = np.max(np.abs(audio_data))
+                        # Get audio data and ensure it's in the correct format
+                        audio_data = frame_samples(frame)
+                        if not audio_data.size:
+                            continue  # Resampler is still buffering input
 
-                        # Normalize only if needed (if max amplitude is too low or too high)
-                        if max_val > 1.0 or max_val < 0.1:
-                            # Normalize to appropriate range for good volume
-                            audio_data = audio_data / max_val * 0.8
-
-                        # Apply a small gain boost if volume is too low
-                        if max_val < 0.3:
-                            audio_data = audio_data * 1.5
-
-                        # Consider adding a simple limiter to avoid clipping
-                        audio_data = np.clip(audio_data, -0.95, 0.95)
-
-                        # Convert to int16 with proper scaling
-                        pcm_data = (audio_data * 32767).astype(np.int16).tobytes()
+                        # Improved conversion to int16 with proper normalization
+                        pcm_data = to_pcm(audio_data)
 
                         # Save the audio data if recording is enabled
                         if self.should_record and self.wav_file:
-                            self.all_audio_data.extend(pcm_data)
+                            size = len(pcm_data)
+                            start = self.buffered_audio
+                            # Copy into the pre-sized buffer; it only grows
+                            # if a single frame is larger than its capacity
+                            self.all_audio_data[start:start + size] = pcm_data
+                            self.buffered_audio = start + size
+                            self.recorded_bytes += size
+                            if self.buffered_audio >= self.max_buffered_audio:
+                                await self._flush_recording()
                     except Exception as e:
-                        logger.error(f"Error converting audio data: {e}")
+                        # A persistent fault hits every frame (~50/s), so only
+                        # log the first failure and then every 100th
+                        conversion_errors += 1
+                        if conversion_errors % 100 == 1:
+                            logger.error(
+                                f"Error converting audio data ({conversion_errors} so far): {e}"
+                            )
                         continue  # Skip this frame if conversion fails
 
                     # Prebuffering stage
                     if not self.prebuffer_done:
-                        self.audio_queue.put(
-                            pcm_data
-                        )  # Use blocking put during prebuffer
+                        enqueue(pcm_data)
                         prebuffer_frames += 1
 
                         if prebuffer_frames >= self.prebuffer_count:
@@ -179,73 +277,102 @@ class AudioStreamPlayer:
                             )
                     else:
                         # Regular operation - try to maintain a consistent buffer level
-                        current_buffer_level = self.audio_queue.qsize()
+                        current_buffer_level = len(audio_queue)
 
                         # If buffer is getting too full, remove some frames to maintain low latency
-                        if current_buffer_level > 0.8 * self.audio_queue.maxsize:
+                        if current_buffer_level > high_water:
                             # Remove older frames to make room
-                            frames_to_drop = int(
-                                current_buffer_level * 0.3
+                            frames_to_drop = (
+                                current_buffer_level * 3 // 10
                             )  # Drop 30% of frames if backed up
                             for _ in range(frames_to_drop):
                                 try:
-                                    self.audio_queue.get_nowait()
-                                except queue.Empty:
+                                    dequeue()
+                                except IndexError:
                                     break
 
-                        # Add the current frame
-                        try:
-                            self.audio_queue.put_nowait(pcm_data)
-                        except queue.Full:
-                            # If still full, drop oldest frame
-                            self.audio_queue.get_nowait()
-                            self.audio_queue.put_nowait(pcm_data)
+                        # Add the current frame; a full deque drops its oldest
+                        enqueue(pcm_data)
 
                 except MediaStreamError:
                     logger.warning("Media stream error, stopping playback")
                     break
         except Exception as e:
-            logger.error(f"Error in receive_frames: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception(f"Error in receive_frames: {e}")
         finally:
             logger.info("Stopping frame receiver")
 
+    def _write_recording(self, size):
+        """Write buffered audio to the WAV file, disabling recording if it fails."""
+        try:
+            with memoryview(self.all_audio_data) as view:
+                # Header sizes are patched once, on close
+                self.wav_file.writeframesraw(view[:size])
+        except Exception as e:
+            logger.error(f"Error writing audio recording, recording disabled: {e}")
+            self.should_record = False
+
+    async def _flush_recording(self):
+        """Hand buffered audio to a worker thread and empty the buffer."""
+        if not self.buffered_audio:
+            return
+        size, self.buffered_audio = self.buffered_audio, 0
+        # Shield the write so cancelling the receiver can't abandon it
+        # mid-file; stop() waits for it before closing the WAV file.
+        # The buffer is only refilled once this await returns.
+        self._recording_write = asyncio.ensure_future(
+            asyncio.to_thread(self._write_recording, size)
+        )
+        await asyncio.shield(self._recording_write)
+
     async def stop(self):
         """Stop playing audio and save recording if enabled."""
-        if self.running:
-            self.running = False
+        if not self.running:
+            return
+        self.running = False
 
-            # Cancel the worker task
-            if hasattr(self, "worker_task"):
-                self.worker_task.cancel()
-                try:
-                    await self.worker_task
-                except asyncio.CancelledError:
-                    pass
-
-            # Stop and close the PyAudio stream
-            if self.stream:
-                self.stream.stop_stream()
-                self.stream.close()
-                self.stream = None
-
-            # Terminate PyAudio
-            if self.pyaudio_instance:
-                self.pyaudio_instance.terminate()
-                self.pyaudio_instance = None
-
-            # Finalize recording if enabled
-            if self.should_record and self.wav_file:
-                try:
-                    # Write all collected audio data to the WAV file
-                    if self.all_audio_data:
-                        self.wav_file.writeframes(self.all_audio_data)
-                    self.wav_file.close()
-                    logger.info(f"Saved server audio to {self.recording_filename}")
-                except Exception as e:
-                    logger.error(f"Error saving audio recording: {e}")
+        # Cancel the worker task
+        if self.worker_task:
+            self.worker_task.cancel()
+            try:
+                await self.worker_task
+            except asyncio.CancelledError:
+                pass
+
+        # Stop and close the PyAudio stream
+        if self.stream:
+            self.stream.stop_stream()
+            self.stream.close()
+            self.stream = None
+
+        # Terminate PyAudio
+        if self.pyaudio_instance:
+            self.pyaudio_instance.terminate()
+            self.pyaudio_instance = None
+
+        await self._finalize_recording()
 
-            logger.info("Stopped audio playback")
+        logger.info("Stopped audio playback")
+
+    async def _finalize_recording(self):
+        """Write out any buffered audio and close the WAV file."""
+        if not self.wav_file:
+            return
+        try:
+            if self._recording_write:
+                await self._recording_write
+            # Write any remaining buffered audio to the WAV file
+            if self.should_record:
+                await self._flush_recording()
+            # Closing flushes the file and patches the header; keep that
+            # disk I/O off the event loop like the spills
+            await asyncio.to_thread(self.wav_file.close)
+            duration = self.recorded_bytes / (2 * self.sample_rate)
+            logger.info(
+                f"Saved {duration:.1f}s of server audio to {self.recording_filename}"
+            )
+        except Exception as e:
+            logger.error(f"Error saving audio recording: {e}")
 
 
 class MicrophoneStreamTrack(AudioStreamTrack):
@@ -255,14 +382,14 @@ class MicrophoneStreamTrack(AudioStreamTrack):
         super().__init__()
         self.sample_rate = 48000
         self.channels = 1
+        self.layout = CHANNEL_LAYOUTS[self.channels]
         self.sample_width = 2  # 16-bit
         self.running = False
         self.audio_queue = asyncio.Queue()
-        # Thread-safe queue for PyAudio callback
-        self.thread_queue = queue.Queue()
+        # Event loop that the PyAudio callback thread hands audio to
+        self._loop = None
         self.pyaudio_instance = pyaudio.PyAudio()
         self.stream = None
-        self._task = None
         # For timestamp tracking
         self._timestamp = 0
         self._samples_per_frame = 960  # 20ms at 48kHz
@@ -272,31 +399,20 @@ class MicrophoneStreamTrack(AudioStreamTrack):
     def audio_callback(self, in_data, frame_count, time_info, status):
         """PyAudio callback to capture microphone data"""
         if self.running and self.connection_active:
-            # Only put data in queue if connection is still active
-            self.thread_queue.put(in_data)
-        return (None, pyaudio.paContinue)
-
-    async def _transfer_audio_data(self):
-        """Transfer audio data from thread queue to asyncio queue"""
-        while self.running and self.connection_active:
+            # Only put data in queue if connection is still active. Hand it
+            # straight to the event loop, which wakes any waiting recv()
             try:
-                # Check if there's data in the thread queue
-                if not self.thread_queue.empty():
-                    # Get data from thread queue
-                    data = self.thread_queue.get_nowait()
-                    # Put data in asyncio queue
-                    await self.audio_queue.put(data)
-                else:
-                    # Small sleep to prevent CPU spinning
-                    await asyncio.sleep(0.001)
-            except Exception as e:
-                logger.error(f"Error transferring audio data: {e}")
-                await asyncio.sleep(0.001)
+                self._loop.call_soon_threadsafe(self.audio_queue.put_nowait, in_data)
+            except RuntimeError:
+                # The event loop has already been closed
+                pass
+        return (None, pyaudio.paContinue)
 
     async def start(self):
         """Start capturing audio from the microphone."""
         self.running = True
         self.connection_active = True
+        self._loop = asyncio.get_running_loop()
 
         # Start PyAudio stream for microphone capture
         self.stream = self.pyaudio_instance.open(
@@ -311,9 +427,6 @@ class MicrophoneStreamTrack(AudioStreamTrack):
         self.stream.start_stream()
         logger.info("Started microphone capture")
 
-        # Start the task to transfer data from thread queue to asyncio queue
-        self._task = asyncio.create_task(self._transfer_audio_data())
-
     def set_connection_inactive(self):
         """Mark the connection as inactive to stop sending data"""
         self.connection_active = False
@@ -321,43 +434,30 @@ class MicrophoneStreamTrack(AudioStreamTrack):
 
     async def stop(self):
         """Stop capturing audio."""
-        if self.running:
-            self.running = False
-            self.connection_active = False
-
-            # Clear any remaining data in queues
-            while not self.thread_queue.empty():
-                try:
-                    self.thread_queue.get_nowait()
-                except:
-                    pass
-
-            while not self.audio_queue.empty():
-                try:
-                    await self.audio_queue.get()
-                except:
-                    pass
+        if not self.running:
+            return
+        self.running = False
+        self.connection_active = False
 
-            # Cancel the transfer task
-            if self._task:
-                self._task.cancel()
-                try:
-                    await self._task
-                except asyncio.CancelledError:
-                    pass
+        # Clear any remaining data in the queue
+        while not self.audio_queue.empty():
+            try:
+                await self.audio_queue.get()
+            except:
+                pass
 
-            # Stop and close the PyAudio stream
-            if self.stream:
-                self.stream.stop_stream()
-                self.stream.close()
-                self.stream = None
+        # Stop and close the PyAudio stream
+        if self.stream:
+            self.stream.stop_stream()
+            self.stream.close()
+            self.stream = None
 
-            # Terminate PyAudio
-            if self.pyaudio_instance:
-                self.pyaudio_instance.terminate()
-                self.pyaudio_instance = None
+        # Terminate PyAudio
+        if self.pyaudio_instance:
+            self.pyaudio_instance.terminate()
+            self.pyaudio_instance = None
 
-            logger.info("Stopped microphone capture")
+        logger.info("Stopped microphone capture")
 
     async def recv(self):
         """Get audio frame from the microphone."""
@@ -376,9 +476,6 @@ class MicrophoneStreamTrack(AudioStreamTrack):
             # Get timestamp (use parent class method)
             pts, time_base = await self._next_timestamp()
 
-            # Create audio frame using the proper imported package
-            from av import AudioFrame
-
             # Create frame from raw audio data - keep as signed 16-bit for Opus codec
             # Don't convert to float, keep as int16
             audio_array = np.frombuffer(audio_data, dtype=np.int16)
@@ -386,7 +483,7 @@ class MicrophoneStreamTrack(AudioStreamTrack):
             # Create AudioFrame using the raw audio data as s16 format
             frame = AudioFrame(
                 format="s16",
-                layout="mono" if self.channels == 1 else "stereo",
+                layout=self.layout,
                 samples=len(audio_array) // self.channels,
             )
 
@@ -400,8 +497,7 @@ class MicrophoneStreamTrack(AudioStreamTrack):
 
             return frame
         except Exception as e:
-            logger.error(f"Error in microphone track recv: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception(f"Error in microphone track recv: {e}")
             # Signal that the track should stop
             if self.running:
                 asyncio.create_task(self.stop())
@@ -451,8 +547,7 @@ async def run_test_client(server_url="http://host.docker.internal:8000"):
         pc.addTrack(mic_track)
         logger.info("Added microphone track to peer connection")
     except Exception as e:
-        logger.error(f"Error setting up microphone track: {e}")
-        logger.error(traceback.format_exc())
+        logger.exception(f"Error setting up microphone track: {e}")
 
     @dc.on("open")
     def on_open():
@@ -595,4 +690,10 @@ async def run_test_client(server_url="http://host.docker.internal:8000"):
 
 
 if __name__ == "__main__":
-    asyncio.run(run_test_client())
+    # Prefer uvloop's faster event loop where it is available (not on Windows)
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(run_test_client())
+    else:
+        uvloop.run(run_test_client())
@@ -2,15 +2,17 @@ import asyncio
 import logging
 import os
 import time
-import traceback
 import uuid
 import wave
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Dict, List
+from typing import Dict, List, Optional
 
+import orjson
 from aiortc import RTCPeerConnection, RTCSessionDescription
 from aiortc.contrib.media import MediaPlayer, MediaRecorder, MediaRelay
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 
@@ -21,17 +23,25 @@ os.makedirs("logs", exist_ok=True)
 # Create a unique log filename with timestamp
 log_filename = f"logs/server_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
 
+# Log level can be raised in production, e.g. LOG_LEVEL=INFO
+log_level_name = os.environ.get("LOG_LEVEL", "DEBUG").upper()
+log_level = logging.getLevelName(log_level_name)
+unknown_log_level = not isinstance(log_level, int)
+if unknown_log_level:
+    # e.g. a typo: fall back rather than fail at import
+    log_level = logging.DEBUG
+
 # Set up logging to both console and file
 logger = logging.getLogger("WebRTC-Server")
-logger.setLevel(logging.DEBUG)  # Set to DEBUG for more detailed logs
+logger.setLevel(log_level)  # DEBUG by default for more detailed logs
 
 # Create console handler
 console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.DEBUG)
+console_handler.setLevel(log_level)
 
 # Create file handler
 file_handler = logging.FileHandler(log_filename)
-file_handler.setLevel(logging.DEBUG)
+file_handler.setLevel(log_level)
 
 # Create formatter and add it to the handlers
 formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
@@ -42,9 +52,20 @@ file_handler.setFormatter(formatter)
 logger.addHandler(console_handler)
 logger.addHandler(file_handler)
 
+if unknown_log_level:
+    logger.warning(f"Unknown LOG_LEVEL {log_level_name!r}, using DEBUG")
+
 logger.info(f"Logging to file: {log_filename}")
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Finalize any open recordings when the server stops
+    await close_all_sessions()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -61,33 +82,119 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 # Create a media relay for sharing a single media source
 relay = MediaRelay()
 
-# Store active peer connections
-peer_connections: Dict[str, RTCPeerConnection] = {}
 
-# Store audio recorders
-audio_recorders: Dict[str, MediaRecorder] = {}
+@dataclass
+class ClientSession:
+    """Per-client state for an active WebRTC connection."""
+
+    # Declared by hand: dataclass(slots=True) needs Python 3.10
+    __slots__ = ("pc", "recorder", "recording_filename")
+
+    pc: RTCPeerConnection
+    recorder: MediaRecorder
+    recording_filename: str
+
+
+# Store active client sessions, keyed by peer connection ID
+client_sessions: Dict[str, ClientSession] = {}
+
+# Limit on sessions cleaned up at once when the server shuts down
+MAX_CONCURRENT_CLEANUPS = 16
+
+# Seconds to wait at shutdown for each recorder to finish writing its file.
+# A recorder still busy after this is abandoned, possibly leaving its WAV
+# unfinalized, so that one stuck recorder can't hang shutdown. Ordinary
+# disconnects wait for the recorder without a timeout.
+RECORDER_STOP_TIMEOUT = 5.0
 
 # Ensure recordings directory exists
 os.makedirs("server_recordings", exist_ok=True)
 
+# Audio file streamed to every client
+audio_file_path = "static/sample.wav"
+
+# Probe the audio file once at startup rather than on every offer
+try:
+    with wave.open(audio_file_path, "rb") as wave_file:
+        audio_file_info = {
+            "channels": wave_file.getnchannels(),
+            "sample_width": wave_file.getsampwidth(),
+            "framerate": wave_file.getframerate(),
+            "frames": wave_file.getnframes(),
+        }
+    logger.debug("Audio file info: %s", audio_file_info)
+except Exception as e:
+    logger.warning(f"Could not read audio file {audio_file_path}: {e}")
+
+
+async def cleanup_session(pc_id: str, stop_timeout: Optional[float] = None):
+    """Stop recording and close the peer connection for a client session."""
+    # Claim the session with a single pop so a repeated state change
+    # (closing the pc fires "closed") can't clean up twice
+    session = client_sessions.pop(pc_id, None)
+    if session is None:
+        return
+
+    # Stop the recorder if it's still running
+    async def stop_recorder():
+        try:
+            logger.info(
+                f"Stopping recording client audio to {session.recording_filename}"
+            )
+            stop = session.recorder.stop()
+            if stop_timeout is not None:
+                stop = asyncio.wait_for(stop, stop_timeout)
+            await stop
+            logger.info(
+                f"Successfully stopped recording to {session.recording_filename}"
+            )
+        except Exception as e:
+            logger.exception(f"Error stopping recorder: {e}")
+
+    # Close the peer connection if not already closed
+    async def close_connection():
+        try:
+            if session.pc.connectionState != "closed":
+                await session.pc.close()
+            logger.info(f"Successfully removed connection {pc_id}")
+        except Exception as e:
+            logger.exception(f"Error closing peer connection: {e}")
+
+    # The two are independent, so overlap them
+    await asyncio.gather(stop_recorder(), close_connection())
+
+
+async def close_all_sessions():
+    """Clean up every remaining client session, a bounded number at a time."""
+    if not client_sessions:
+        return
+    logger.info(f"Closing {len(client_sessions)} client session(s)")
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_CLEANUPS)
+
+    async def bounded_cleanup(pc_id):
+        async with semaphore:
+            await cleanup_session(pc_id, stop_timeout=RECORDER_STOP_TIMEOUT)
+
+    await asyncio.gather(*(bounded_cleanup(pc_id) for pc_id in list(client_sessions)))
+
 
 @app.post("/offer")
 async def offer(request: Request):
     try:
-        data = await request.json()
+        # Parse the SDP offer with orjson rather than the stdlib json module
+        data = orjson.loads(await request.body())
         offer = RTCSessionDescription(sdp=data["sdp"], type=data["type"])
-        pc_id = str(uuid.uuid4())
+        pc_id = uuid.uuid4().hex
         logger.info(f"Received offer from client, created PC with ID: {pc_id}")
 
         # Create a new WebRTC connection
         pc = RTCPeerConnection()
-        peer_connections[pc_id] = pc
 
         # Create recording filename
         timestamp = int(time.time())
         recording_filename = f"server_recordings/client_audio_{pc_id}_{timestamp}.wav"
         recorder = MediaRecorder(recording_filename)
-        audio_recorders[pc_id] = recorder
+        client_sessions[pc_id] = ClientSession(pc, recorder, recording_filename)
 
         # Track ICE candidates
         @pc.on("icecandidate")
@@ -122,51 +229,11 @@ async def offer(request: Request):
                     f"Connection {pc_id} is {pc.connectionState}, cleaning up resources"
                 )
 
-                # Stop the recorder if it's still running
-                if pc_id in audio_recorders:
-                    try:
-                        recorder = audio_recorders[pc_id]
-                        logger.info(
-                            f"Stopping recording client audio to {recording_filename}"
-                        )
-                        await recorder.stop()
-                        logger.info(
-                            f"Successfully stopped recording to {recording_filename}"
-                        )
-                        del audio_recorders[pc_id]
-                    except Exception as e:
-                        logger.error(f"Error stopping recorder: {e}")
-                        logger.error(traceback.format_exc())
-
-                # Remove peer connection from active connections
-                if pc_id in peer_connections:
-                    try:
-                        # Close the peer connection if not already closed
-                        if pc.connectionState != "closed":
-                            await pc.close()
-                        del peer_connections[pc_id]
-                        logger.info(f"Successfully removed connection {pc_id}")
-                    except Exception as e:
-                        logger.error(f"Error closing peer connection: {e}")
-                        logger.error(traceback.format_exc())
-                        # Still try to remove from dictionary even if close fails
-                        if pc_id in peer_connections:
-                            del peer_connections[pc_id]
+                await cleanup_session(pc_id)
 
         # Set up audio stream from sample.wav
         try:
-            # Check if the file exists and is a valid audio file
-            audio_file_path = "static/sample.wav"
-            logger.debug(f"Attempting to open audio file: {audio_file_path}")
-
-            with wave.open(audio_file_path, "rb") as wave_file:
-                info = {
-                    "channels": wave_file.getnchannels(),
-                    "sample_width": wave_file.getsampwidth(),
-                    "framerate": wave_file.getframerate(),
-                    "frames": wave_file.getnframes(),
-                }
-                logger.debug(f"Audio file info: {info}")
+            logger.debug("Attempting to open audio file: %s", audio_file_path)
 
             # Create the media player for the audio file with improved options
             player = MediaPlayer(
@@ -184,25 +251,26 @@ async def offer(request: Request):
 
             if player.audio:
                 logger.info("Audio track created successfully")
-                audio_track = relay.subscribe(player.audio)
+                # Unbuffered: a slow client gets the latest frame instead of
+                # a growing backlog, so its latency stays bounded
+                audio_track = relay.subscribe(player.audio, buffered=False)
                 pc.addTrack(audio_track)
                 logger.info("Added audio track to peer connection")
             else:
                 logger.warning("No audio track found in sample.wav")
         except Exception as e:
-            logger.error(f"Error setting up audio track: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception(f"Error setting up audio track: {e}")
             # Continue without audio if there's an error
 
         # Set the remote description
         try:
             logger.info("Setting remote description with offer from client")
-            logger.debug(f"Offer SDP: {offer.sdp}")
+            # Lazy %-formatting: SDP bodies are only rendered at DEBUG
+            logger.debug("Offer SDP: %s", offer.sdp)
             await pc.setRemoteDescription(offer)
             logger.info("Remote description set")
         except Exception as e:
-            logger.error(f"Error setting remote description: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception(f"Error setting remote description: {e}")
             raise HTTPException(status_code=400, detail=str(e))
 
         # Create answer
@@ -211,21 +279,30 @@ async def offer(request: Request):
             answer = await pc.createAnswer()
             await pc.setLocalDescription(answer)
             logger.info("Local description set")
-            logger.debug(f"Answer SDP: {pc.localDescription.sdp}")
+            logger.debug("Answer SDP: %s", pc.localDescription.sdp)
         except Exception as e:
-            logger.error(f"Error creating answer: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception(f"Error creating answer: {e}")
             raise HTTPException(status_code=500, detail=str(e))
 
-        return {"sdp": pc.localDescription.sdp, "type": pc.localDescription.type}
+        answer_json = orjson.dumps(
+            {"sdp": pc.localDescription.sdp, "type": pc.localDescription.type}
+        )
+        return Response(answer_json, media_type="application/json")
     except Exception as e:
-        logger.error(f"Unexpected error: {e}")
-        logger.error(traceback.format_exc())
+        logger.exception(f"Unexpected error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
 if __name__ == "__main__":
     import uvicorn
 
-    logger.info("Starting WebRTC server on port 8000...")
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Prefer uvloop's faster event loop where it is available (not on Windows)
+    try:
+        import uvloop  # noqa: F401
+
+        loop = "uvloop"
+    except ImportError:
+        loop = "asyncio"
+
+    logger.info(f"Starting WebRTC server on port 8000 ({loop} event loop)...")
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop=loop)
@@ -3,6 +3,7 @@ import os
 import wave
 import pytest
 import numpy as np
+import av
 import fractions
 import queue
 from unittest.mock import patch, MagicMock, AsyncMock
@@ -15,6 +16,17 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from client import AudioStreamPlayer, MicrophoneStreamTrack
 
 
+def make_stereo_frame(pts, samples=960):
+    """Build an s16 stereo frame like the ones aiortc's Opus decoder returns"""
+    t = np.arange(pts, pts + samples)
+    mono = (np.sin(2*np.pi*440*t/48000) * 16000).astype(np.int16)
+    frame = av.AudioFrame.from_ndarray(np.repeat(mono, 2).reshape(1, -1), format="s16", layout="stereo")
+    frame.sample_rate = 48000
+    frame.pts = pts
+    frame.time_base = fractions.Fraction(1, 48000)
+    return frame
+
+
 class TestAudioStreamPlayer:
     """Tests for the AudioStreamPlayer class"""
     
@@ -22,14 +34,16 @@ class TestAudioStreamPlayer:
     def mock_track(self):
         """Create a mock audio track"""
         track = MagicMock()
-        # Create a mock frame that will be returned by the track
-        mock_frame = MagicMock()
-        # Configure the mock to return audio data when to_ndarray is called
-        mock_frame.to_ndarray.return_value = np.zeros(1024, dtype=np.float32)
-        
-        # Configure the recv method to return the mock frame when awaited
+        frames_sent = 0
+
+        # Configure the recv method to return decoded-style frames when awaited
         async def mock_recv():
-            return mock_frame
+            nonlocal frames_sent
+            # Yield to the event loop like a real track would
+            await asyncio.sleep(0)
+            frame = make_stereo_frame(frames_sent * 1024, samples=1024)
+            frames_sent += 1
+            return frame
             
         track.recv = mock_recv
         return track
@@ -82,14 +96,15 @@ class TestAudioStreamPlayer:
     @pytest.mark.asyncio
     async def test_receive_frames(self, audio_player, mock_track):
         """Test receiving frames from the track"""
-        # Create a mock audio frame
-        mock_frame = MagicMock()
-        mock_audio_data = np.zeros(1024, dtype=np.float32)
-        mock_frame.to_ndarray.return_value = mock_audio_data
-        
-        # Update the mock_track recv to return our specific frame
+        frames_sent = 0
+
+        # Update the mock_track recv to return real audio frames
         async def mock_recv():
-            return mock_frame
+            nonlocal frames_sent
+            await asyncio.sleep(0)
+            frame = make_stereo_frame(frames_sent * 1024, samples=1024)
+            frames_sent += 1
+            return frame
             
         mock_track.recv = mock_recv
         
@@ -119,14 +134,15 @@ class TestAudioStreamPlayer:
         test_recording_path = "client_recordings/test_recording.wav"
         player.recording_filename = test_recording_path
         
-        # Create a mock audio frame with known data
-        mock_frame = MagicMock()
-        test_audio = np.sin(np.linspace(0, 2*np.pi, 1024)) * 0.5  # Sine wave at half amplitude
-        mock_frame.to_ndarray.return_value = test_audio
-        
-        # Update the mock_track recv to return our specific frame
+        frames_sent = 0
+
+        # Update the mock_track recv to return frames with a known sine wave
         async def mock_recv():
-            return mock_frame
+            nonlocal frames_sent
+            await asyncio.sleep(0)
+            frame = make_stereo_frame(frames_sent * 1024, samples=1024)
+            frames_sent += 1
+            return frame
             
         mock_track.recv = mock_recv
         
@@ -161,13 +177,101 @@ class TestAudioStreamPlayer:
                     await player.stop()
                     
                     # Check that wave file was closed and data was written
-                    mock_wave_file.writeframes.assert_called()
+                    mock_wave_file.writeframesraw.assert_called()
                     mock_wave_file.close.assert_called_once()
         finally:
             # Clean up the test file if it was created
             if os.path.exists(test_recording_path):
                 os.remove(test_recording_path)
 
+    @pytest.mark.asyncio
+    async def test_recording_spills_to_disk(self):
+        """Test that buffered audio is written out once it passes max_buffered_audio"""
+        # Each stereo frame downmixes to 1024 mono int16 samples (2048 bytes)
+        frames_sent = 0
+
+        track = MagicMock()
+
+        async def mock_recv():
+            nonlocal frames_sent
+            # Yield to the event loop like a real track would
+            await asyncio.sleep(0)
+            if frames_sent >= 5:
+                raise MediaStreamError
+            frame = make_stereo_frame(frames_sent * 1024, samples=1024)
+            frames_sent += 1
+            return frame
+
+        track.recv = mock_recv
+
+        with patch('pyaudio.PyAudio') as mock_pyaudio, patch('wave.open') as mock_wave_open:
+            mock_pyaudio.return_value.open.return_value = MagicMock()
+            mock_wave_file = MagicMock()
+            mock_wave_open.return_value = mock_wave_file
+
+            player = AudioStreamPlayer(track, buffer_size=1024)
+            # Spill every two frames
+            player.max_buffered_audio = 4096
+
+            await player.start()
+            await player.worker_task
+
+            # Frames 1-2 and 3-4 were spilled, frame 5 is still buffered
+            assert mock_wave_file.writeframesraw.call_count == 2
+            assert player.buffered_audio == 2048
+
+            await player.stop()
+
+            # The remaining frame is written once on stop
+            assert mock_wave_file.writeframesraw.call_count == 3
+            assert player.buffered_audio == 0
+            mock_wave_file.close.assert_called_once()
+
+    @pytest.mark.asyncio
+    async def test_playback_uses_whole_frames(self):
+        """Test that decoded 960-sample frames fill each callback at the default buffer size"""
+        frames_sent = 0
+
+        track = MagicMock()
+
+        async def mock_recv():
+            nonlocal frames_sent
+            await asyncio.sleep(0)
+            if frames_sent >= 5:
+                raise MediaStreamError
+            frame = make_stereo_frame(frames_sent * 960)
+            frames_sent += 1
+            return frame
+
+        track.recv = mock_recv
+
+        with patch('pyaudio.PyAudio') as mock_pyaudio:
+            mock_pyaudio.return_value.open.return_value = MagicMock()
+
+            player = AudioStreamPlayer(track)
+            player.should_record = False
+
+            await player.start()
+            await player.worker_task
+
+            # The stream asks for exactly one decoded frame per callback
+            assert mock_pyaudio.return_value.open.call_args[1]['frames_per_buffer'] == 960
+
+            # Every received frame is played whole, without padding or drops
+            for _ in range(5):
+                queued = player.audio_queue[0]
+                data, _ = player.audio_callback(None, player.buffer_size, None, None)
+                # Exact-size frames are handed to PyAudio without a copy
+                assert data is queued
+                assert len(data) == 1920
+                assert any(data[-64:])
+
+            # Once the queue is drained the callback plays silence
+            data, _ = player.audio_callback(None, player.buffer_size, None, None)
+            assert data == bytes(1920)
+
+            await player.stop()
+
 
 class TestMicrophoneStreamTrack:
     """Tests for the MicrophoneStreamTrack class"""
@@ -233,11 +337,11 @@ class TestMicrophoneStreamTrack:
             await mic_track.start()
             
             try:
-                # Put test data in the thread queue
-                mic_track.thread_queue.put(test_audio_bytes)
+                # Deliver test data through the PyAudio callback
+                mic_track.audio_callback(test_audio_bytes, 960, None, None)
                 
                 # Mock the AudioFrame creation
-                with patch('av.AudioFrame') as mock_audio_frame:
+                with patch('client.AudioFrame') as mock_audio_frame:
                     # Configure the mock frame
                     mock_frame = MagicMock()
                     mock_audio_frame.return_value = mock_frame
@@ -7,7 +7,7 @@ from unittest.mock import patch, MagicMock, AsyncMock
 from aiortc import RTCPeerConnection, RTCSessionDescription
 from fastapi import HTTPException
 
-from server import app, peer_connections, audio_recorders
+from server import app, client_sessions, ClientSession, close_all_sessions
 
 
 class TestServer:
@@ -77,23 +77,22 @@ class TestServer:
         """Test the connection state change handler"""
         # Create a unique ID for the test peer connection
         pc_id = str(uuid.uuid4())
-        peer_connections[pc_id] = rtc_peer_connection
         
         # Create a mock recorder
         mock_recorder = MagicMock()
         mock_recorder.stop = AsyncMock()
-        audio_recorders[pc_id] = mock_recorder
+        client_sessions[pc_id] = ClientSession(
+            rtc_peer_connection, mock_recorder, "server_recordings/test.wav"
+        )
         
         # Manually attach a test event handler to the connection state change
         # since _eventlisteners is not available in the current aiortc version
         connectionstate_handler = None
         
         async def test_handler():
-            if pc_id in audio_recorders:
-                await audio_recorders[pc_id].stop()
-                del audio_recorders[pc_id]
-            if pc_id in peer_connections:
-                del peer_connections[pc_id]
+            if pc_id in client_sessions:
+                await client_sessions[pc_id].recorder.stop()
+                del client_sessions[pc_id]
         
         # Attach the test handler
         rtc_peer_connection.on("connectionstatechange", test_handler)
@@ -104,8 +103,28 @@ class TestServer:
         
         # Verify that resources were cleaned up
         mock_recorder.stop.assert_called_once()
-        assert pc_id not in peer_connections
-        assert pc_id not in audio_recorders
+        assert pc_id not in client_sessions
+
+    @pytest.mark.asyncio
+    async def test_close_all_sessions(self):
+        """Test that shutdown stops every recorder and closes every connection"""
+        sessions = []
+        for i in range(3):
+            mock_pc = MagicMock()
+            mock_pc.connectionState = "connected"
+            mock_pc.close = AsyncMock()
+            mock_recorder = MagicMock()
+            mock_recorder.stop = AsyncMock()
+            session = ClientSession(mock_pc, mock_recorder, f"server_recordings/test_{i}.wav")
+            client_sessions[f"test-{i}"] = session
+            sessions.append(session)
+
+        await close_all_sessions()
+
+        assert not any(pc_id.startswith("test-") for pc_id in client_sessions)
+        for session in sessions:
+            session.recorder.stop.assert_awaited_once()
+            session.pc.close.assert_awaited_once()
 
     def test_static_files(self, test_client):
         """Test that static files are served correctly"""